@@ -224,6 +224,8 @@ class ResNet(Chain):
         Spatial size of the expected input image.
     classes : int, default 1000
         Number of classification classes.
+    features_only : bool, default False
+        Whether to build only the feature extractor (without the classification head).
     """
     def __init__(self,
                  channels,
@@ -232,10 +234,12 @@ class ResNet(Chain):
                  conv1_stride,
                  in_channels=3,
                  in_size=(224, 224),
-                 classes=1000):
+                 classes=1000,
+                 features_only=False):
         super(ResNet, self).__init__()
         self.in_size = in_size
         self.classes = classes
+        self.features_only = features_only
 
         with self.init_scope():
             self.features = SimpleSequential()
@@ -262,18 +266,20 @@ class ResNet(Chain):
                     ksize=7,
                     stride=1))
 
-            self.output = SimpleSequential()
-            with self.output.init_scope():
-                setattr(self.output, "flatten", partial(
-                    F.reshape,
-                    shape=(-1, in_channels)))
-                setattr(self.output, "fc", L.Linear(
-                    in_size=in_channels,
-                    out_size=classes))
+            if not self.features_only:
+                self.output = SimpleSequential()
+                with self.output.init_scope():
+                    setattr(self.output, "flatten", partial(
+                        F.reshape,
+                        shape=(-1, in_channels)))
+                    setattr(self.output, "fc", L.Linear(
+                        in_size=in_channels,
+                        out_size=classes))
 
     def __call__(self, x):
         x = self.features(x)
-        x = self.output(x)
+        if not self.features_only:
+            x = self.output(x)
         return x
 
 
@@ -148,6 +148,8 @@ class ResNetA(Chain):
         Spatial size of the expected input image.
     classes : int, default 1000
         Number of classification classes.
+    features_only : bool, default False
+        Whether to build only the feature extractor (without the classification head).
     """
     def __init__(self,
                  channels,
@@ -158,10 +160,12 @@ class ResNetA(Chain):
                  in_channels=3,
                  in_size=(224, 224),
                  classes=1000,
+                 features_only=False,
                  **kwargs):
         super(ResNetA, self).__init__(**kwargs)
         self.in_size = in_size
         self.classes = classes
+        self.features_only = features_only
 
         with self.init_scope():
             self.features = SimpleSequential()
@@ -194,18 +198,20 @@ class ResNetA(Chain):
                     F.average_pooling_2d,
                     ksize=(in_size[0] // 32, in_size[1] // 32)))
 
-            self.output = SimpleSequential()
-            with self.output.init_scope():
-                setattr(self.output, "flatten", partial(
-                    F.reshape,
-                    shape=(-1, in_channels)))
-                setattr(self.output, "fc", L.Linear(
-                    in_size=in_channels,
-                    out_size=classes))
+            if not self.features_only:
+                self.output = SimpleSequential()
+                with self.output.init_scope():
+                    setattr(self.output, "flatten", partial(
+                        F.reshape,
+                        shape=(-1, in_channels)))
+                    setattr(self.output, "fc", L.Linear(
+                        in_size=in_channels,
+                        out_size=classes))
 
     def __call__(self, x):
         x = self.features(x)
-        x = self.output(x)
+        if not self.features_only:
+            x = self.output(x)
         return x
 
 
@@ -8,16 +8,44 @@ __all__ = ['SimplePose', 'simplepose_resnet18_coco', 'simplepose_resnet50b_coco'
            'simplepose_resneta152b_coco']
 
 import os
+import warnings
 import numpy as np
+import chainer
 import chainer.functions as F
 import chainer.links as L
-from chainer import Chain
+from chainer import Chain, Parameter, Variable
+from chainer.backend import get_array_module
 from chainer.serializers import load_npz
-from .common import get_activation_layer, conv1x1, SimpleSequential
+from .common import get_activation_layer, SimpleSequential
 from .resnet import resnet18, resnet50b, resnet101b, resnet152b
 from .resneta import resneta50b, resneta101b, resneta152b
 
 
+def _fold_bn(conv,
+             bn,
+             scale_weight):
+    """
+    Fold batch normalization layer into the weights and bias of the preceding (de)convolution layer.
+
+    Parameters:
+    ----------
+    conv : chainer.links.Convolution2D or chainer.links.Deconvolution2D
+        (De)convolution layer.
+    bn : chainer.links.BatchNormalization
+        Batch normalization layer.
+    scale_weight : function
+        Function which scales weight array by per-output-channel factors: scale_weight(weight, scale).
+    """
+    scale = bn.gamma.array / conv.xp.sqrt(bn.avg_var + bn.eps)
+    conv.W.array = scale_weight(conv.W.array, scale)
+    bias = bn.beta.array - bn.avg_mean * scale
+    if conv.b is not None:
+        conv.b.array = bias + conv.b.array * scale
+    else:
+        with conv.init_scope():
+            conv.b = Parameter(bias)
+
+
 class DeconvBlock(Chain):
     """
     Deconvolution block with batch normalization and activation.
@@ -89,6 +117,136 @@ class DeconvBlock(Chain):
             x = self.activ(x)
         return x
 
+    def fuse_bn(self):
+        """
+        Fold the batch normalization layer into the deconvolution weights and bias (for inference only).
+        """
+        if not self.use_bn:
+            return
+        groups = self.conv.groups
+
+        def scale_weight(weight, scale):
+            in_channels, group_out_channels = weight.shape[:2]
+            weight = weight.reshape((groups, in_channels // groups, group_out_channels) + weight.shape[2:])
+            weight = weight * scale.reshape(groups, 1, group_out_channels, 1, 1)
+            return weight.reshape((in_channels, group_out_channels) + weight.shape[3:])
+
+        _fold_bn(self.conv, self.bn, scale_weight)
+        del self.bn
+        self.use_bn = False
+
+
+class UpConvBlock(Chain):
+    """
+    Upsampling block (bilinear interpolation followed by 3x3 convolution) with batch normalization and activation.
+    It is a lighter replacement for the stride-2 deconvolution block.
+
+    Parameters:
+    ----------
+    in_channels : int
+        Number of input channels.
+    out_channels : int
+        Number of output channels.
+    scale_factor : int, default 2
+        Multiplier for spatial size.
+    use_bias : bool, default False
+        Whether the layer uses a bias vector.
+    use_bn : bool, default True
+        Whether to use BatchNorm layer.
+    bn_eps : float, default 1e-5
+        Small float added to variance in Batch norm.
+    activation : function or str or None, default F.relu
+        Activation function or name of activation function.
+    """
+    def __init__(self,
+                 in_channels,
+                 out_channels,
+                 scale_factor=2,
+                 use_bias=False,
+                 use_bn=True,
+                 bn_eps=1e-5,
+                 activation=(lambda: F.relu),
+                 **kwargs):
+        super(UpConvBlock, self).__init__(**kwargs)
+        self.scale_factor = scale_factor
+        self.activate = (activation is not None)
+        self.use_bn = use_bn
+
+        with self.init_scope():
+            self.conv = L.Convolution2D(
+                in_channels=in_channels,
+                out_channels=out_channels,
+                ksize=3,
+                stride=1,
+                pad=1,
+                nobias=(not use_bias))
+            if self.use_bn:
+                self.bn = L.BatchNormalization(
+                    size=out_channels,
+                    eps=bn_eps)
+            if self.activate:
+                self.activ = get_activation_layer(activation)
+
+    def __call__(self, x):
+        out_size = (x.shape[2] * self.scale_factor, x.shape[3] * self.scale_factor)
+        x = F.resize_images(x, output_shape=out_size)
+        x = self.conv(x)
+        if self.use_bn:
+            x = self.bn(x)
+        if self.activate:
+            x = self.activ(x)
+        return x
+
+    def fuse_bn(self):
+        """
+        Fold the batch normalization layer into the convolution weights and bias (for inference only).
+        """
+        if not self.use_bn:
+            return
+        _fold_bn(self.conv, self.bn, lambda weight, scale: weight * scale.reshape(-1, 1, 1, 1))
+        del self.bn
+        self.use_bn = False
+
+
+class HeatmapBlock(L.Convolution2D):
+    """
+    Final 1x1 convolution block producing keypoint heatmaps. The weights are cast to the input data type for
+    reduced-precision inference, and the ReLU of the last decoder unit can be fused into it (applied in place on the
+    input when backprop is disabled, otherwise as a regular graph op).
+
+    Parameters:
+    ----------
+    in_channels : int
+        Number of input channels.
+    out_channels : int
+        Number of output channels.
+    """
+    def __init__(self,
+                 in_channels,
+                 out_channels,
+                 **kwargs):
+        super(HeatmapBlock, self).__init__(
+            in_channels=in_channels,
+            out_channels=out_channels,
+            ksize=1,
+            nobias=False,
+            **kwargs)
+        self.fused_activ = False
+
+    def forward(self, x):
+        if self.fused_activ:
+            if chainer.config.enable_backprop:
+                x = F.relu(x)
+            else:
+                x_data = x.array if isinstance(x, Variable) else x
+                self.xp.maximum(x_data, 0, out=x_data)
+        if x.dtype != self.W.dtype:
+            return F.convolution_2d(
+                x=x,
+                W=F.cast(self.W, x.dtype),
+                b=F.cast(self.b, x.dtype))
+        return super(HeatmapBlock, self).forward(x)
+
 
 class SimplePose(Chain):
     """
@@ -110,6 +268,17 @@ class SimplePose(Chain):
         Spatial size of the expected input image.
     keypoints : int, default 17
         Number of keypoints.
+    use_deconv : bool, default True
+        Whether to use deconvolution blocks in the decoder (otherwise bilinear upsampling with 3x3 convolution).
+    reuse_output : bool, default False
+        Whether to write keypoints into a buffer reused across calls (the result is overwritten by the next call).
+    infer_dtype : numpy.dtype or None, default None
+        Reduced data type (e.g. numpy.float16) for the final block and keypoint extraction at inference, or None. It
+        is applied on GPU (CuPy) only and ignored on CPU, where NumPy has no fast float16 GEMM and the cast is slower.
+    use_numba : bool, default False
+        Whether to extract keypoints from NumPy heatmaps with a Numba-compiled kernel (if Numba is available).
+    use_soft_argmax : bool, default False
+        Whether to extract keypoints by differentiable soft-argmax (the model should be trained with it).
     """
     def __init__(self,
                  backbone,
@@ -119,6 +288,11 @@ class SimplePose(Chain):
                  in_channels=3,
                  in_size=(256, 192),
                  keypoints=17,
+                 use_deconv=True,
+                 reuse_output=False,
+                 infer_dtype=None,
+                 use_numba=False,
+                 use_soft_argmax=False,
                  **kwargs):
         super(SimplePose, self).__init__(**kwargs)
         assert (in_channels == 3)
@@ -126,6 +300,19 @@ class SimplePose(Chain):
         self.keypoints = keypoints
         self.return_heatmap = return_heatmap
         self.out_size = (in_size[0] // 4, in_size[1] // 4)
+        self._index_cache = {}
+        self.reuse_output = reuse_output
+        self._keypoints_cache = {}
+        self.infer_dtype = infer_dtype
+        self.use_soft_argmax = use_soft_argmax
+        self._numba_refine = None
+        if use_numba:
+            try:
+                from .simplepose_coco_refine import refine_keypoints, NumbaError
+                self._numba_refine = refine_keypoints
+                self._numba_error = NumbaError
+            except ImportError:
+                warnings.warn("Numba is not available, SimplePose keypoints are extracted without it.")
 
         with self.init_scope():
             self.backbone = backbone
@@ -134,45 +321,164 @@ class SimplePose(Chain):
             self.decoder = SimpleSequential()
             with self.decoder.init_scope():
                 for i, out_channels in enumerate(channels):
-                    setattr(self.decoder, "unit{}".format(i + 1), DeconvBlock(
-                        in_channels=in_channels,
-                        out_channels=out_channels,
-                        ksize=4,
-                        stride=2,
-                        pad=1))
+                    if use_deconv:
+                        unit = DeconvBlock(
+                            in_channels=in_channels,
+                            out_channels=out_channels,
+                            ksize=4,
+                            stride=2,
+                            pad=1)
+                    else:
+                        unit = UpConvBlock(
+                            in_channels=in_channels,
+                            out_channels=out_channels)
+                    setattr(self.decoder, "unit{}".format(i + 1), unit)
                     in_channels = out_channels
 
-            self.final_block = conv1x1(
+            self.final_block = HeatmapBlock(
                 in_channels=in_channels,
-                out_channels=keypoints,
-                use_bias=True)
+                out_channels=keypoints)
 
     def __call__(self, x):
-        x = self.backbone(x)
-        x = self.decoder(x)
-        heatmap = self.final_block(x)
+        heatmap = self.forward_heatmap(x)
         if self.return_heatmap:
             return heatmap
-
-        vector_dim = 2
+        if self.use_soft_argmax:
+            return self.soft_argmax(heatmap)
+        return self.refine(heatmap)
+
+    def forward_heatmap(self, x):
+        """
+        Calculate keypoint heatmaps. It is a pure Chainer graph without post-processing, so it is the entry point for
+        exporting the model (e.g. via onnx_chainer). After `fuse_final_activ` it must be traced with backprop enabled,
+        otherwise the fused ReLU is applied outside the graph and is missing from the export.
+
+        Parameters:
+        ----------
+        x : chainer.Variable or numpy.ndarray or cupy.ndarray
+            Input images.
+
+        Returns
+        -------
+        chainer.Variable
+            Heatmaps of shape (batch, keypoints, out_height, out_width).
+        """
+        x = self.backbone(x)
+        x = self.decoder(x)
+        if (self.infer_dtype is not None) and (get_array_module(x) is not np):
+            x = F.cast(x, self.infer_dtype)
+        return self.final_block(x)
+
+    def refine(self, heatmap):
+        """
+        Extract keypoints from heatmaps with quarter-pixel refinement of peak locations.
+
+        Parameters:
+        ----------
+        heatmap : chainer.Variable or numpy.ndarray or cupy.ndarray
+            Heatmaps of shape (batch, keypoints, out_height, out_width) (e.g. output of an exported `forward_heatmap`).
+
+        Returns
+        -------
+        numpy.ndarray or cupy.ndarray
+            Keypoints of shape (batch, keypoints, 3) as (x, y, score) triples (on the device of the heatmaps).
+        """
         batch = heatmap.shape[0]
-        heatmap_vector = F.reshape(heatmap, shape=(batch, self.keypoints, -1))
-        indices = F.cast(F.expand_dims(F.argmax(heatmap_vector, axis=vector_dim), axis=vector_dim), np.float32)
-        scores = F.max(heatmap_vector, axis=vector_dim, keepdims=True)
-        scores_mask = (scores.array > 0.0).astype(np.float32)
-        keys_x = (indices.array % self.out_size[1]) * scores_mask
-        keys_y = (indices.array // self.out_size[1]) * scores_mask
-        keypoints = F.concat((keys_x, keys_y, scores), axis=vector_dim).array
-        for b in range(batch):
-            for k in range(self.keypoints):
-                hm = heatmap[b, k, :, :].array
-                px = int(keys_x[b, k])
-                py = int(keys_y[b, k])
-                if (1 < px < self.out_size[1] - 1) and (1 < py < self.out_size[0] - 1):
-                    keypoints[b, k, 0] += np.sign(hm[py, px + 1] - hm[py, px - 1]) * 0.25
-                    keypoints[b, k, 1] += np.sign(hm[py + 1, px] - hm[py - 1, px]) * 0.25
+        keypoint_count = self.keypoints
+        height, width = self.out_size
+        reuse_output = self.reuse_output
+        hm = heatmap.array if isinstance(heatmap, Variable) else heatmap
+        xp = get_array_module(hm)
+        keypoints = self._keypoints_cache.get((xp, batch)) if reuse_output else None
+        if keypoints is None:
+            keypoints = xp.empty((batch, keypoint_count, 3), dtype=np.float32)
+            if reuse_output:
+                # Only the buffer for the most recent batch size is kept:
+                self._keypoints_cache = {(xp, batch): keypoints}
+        if (self._numba_refine is not None) and (xp is np) and (hm.dtype != np.float16):
+            try:
+                self._numba_refine(hm, keypoints)
+                return keypoints
+            except self._numba_error as e:
+                warnings.warn("Numba keypoint extraction failed ({}), SimplePose falls back to NumPy.".format(e))
+                self._numba_refine = None
+
+        index_arrays = self._index_cache.get((xp, batch))
+        if index_arrays is None:
+            index_arrays = (xp.arange(batch, dtype=np.intp)[:, None], xp.arange(keypoint_count, dtype=np.intp)[None, :])
+            # Only the index arrays for the most recent batch size are kept:
+            self._index_cache = {(xp, batch): index_arrays}
+        b_idx, k_idx = index_arrays
+        indices = hm.reshape((batch, keypoint_count, -1)).argmax(axis=2)
+        py, px = xp.divmod(indices, width)
+        scores = hm[b_idx, k_idx, py, px]
+        scores_mask = (scores > 0.0)
+        xp.multiply(px, scores_mask, out=keypoints[:, :, 0], casting="unsafe")
+        xp.multiply(py, scores_mask, out=keypoints[:, :, 1], casting="unsafe")
+        keypoints[:, :, 2] = scores
+
+        valid = scores_mask & (px > 1) & (px < width - 1) & (py > 1) & (py < height - 1)
+        px = xp.clip(px, 1, width - 2)
+        py = xp.clip(py, 1, height - 2)
+        dx = self._sign_step(xp, hm[b_idx, k_idx, py, px + 1], hm[b_idx, k_idx, py, px - 1])
+        dy = self._sign_step(xp, hm[b_idx, k_idx, py + 1, px], hm[b_idx, k_idx, py - 1, px])
+        keypoints[:, :, 0] += xp.where(valid, dx, 0.0)
+        keypoints[:, :, 1] += xp.where(valid, dy, 0.0)
         return keypoints
 
+    def soft_argmax(self, heatmap):
+        """
+        Extract keypoints from heatmaps as expected coordinates under the spatial softmax of each heatmap. It is a pure
+        Chainer graph (differentiable and without host post-processing).
+
+        Parameters:
+        ----------
+        heatmap : chainer.Variable
+            Heatmaps of shape (batch, keypoints, out_height, out_width).
+
+        Returns
+        -------
+        chainer.Variable
+            Keypoints of shape (batch, keypoints, 3) as (x, y, score) triples.
+        """
+        batch, keypoint_count, height, width = heatmap.shape
+        xp = get_array_module(heatmap)
+        heatmap_vector = F.reshape(heatmap, shape=(batch, keypoint_count, -1))
+        prob = F.reshape(F.softmax(heatmap_vector, axis=2), shape=heatmap.shape)
+        prob_x = F.reshape(F.sum(prob, axis=2), shape=(-1, width))
+        prob_y = F.reshape(F.sum(prob, axis=3), shape=(-1, height))
+        keys_x = F.linear(prob_x, xp.arange(width, dtype=heatmap.dtype)[None, :])
+        keys_y = F.linear(prob_y, xp.arange(height, dtype=heatmap.dtype)[None, :])
+        scores = F.reshape(F.max(heatmap_vector, axis=2), shape=(-1, 1))
+        keypoints = F.reshape(F.concat((keys_x, keys_y, scores), axis=1), shape=(batch, keypoint_count, 3))
+        return F.cast(keypoints, np.float32)
+
+    @staticmethod
+    def _sign_step(xp, a, b):
+        """
+        Quarter-pixel shift towards the larger of two neighbours, i.e. sign(a - b) * 0.25 via two comparisons.
+        """
+        return (xp.greater(a, b).view(np.int8) - xp.less(a, b).view(np.int8)).astype(np.float32) * np.float32(0.25)
+
+    def fuse_bn_all(self):
+        """
+        Fold batch normalization layers of all decoder units into their convolutions (for inference only).
+        """
+        for link in self.links():
+            if isinstance(link, (DeconvBlock, UpConvBlock)):
+                link.fuse_bn()
+
+    def fuse_final_activ(self):
+        """
+        Fuse ReLU of the last decoder unit into the final block. Under `chainer.no_backprop_mode` it is applied in
+        place, which saves the allocation of one more feature map; with backprop enabled it stays a regular graph op
+        (so gradients and model export via `forward_heatmap` remain correct).
+        """
+        last_unit = self.decoder.el(len(self.decoder) - 1)
+        if last_unit.activate and (last_unit.activ is F.relu):
+            last_unit.activate = False
+            self.final_block.fused_activ = True
+
 
 def get_simplepose(backbone,
                    backbone_out_channels,
@@ -237,7 +543,7 @@ def simplepose_resnet18_coco(pretrained_backbone=False, keypoints=17, **kwargs):
     root : str, default '~/.chainer/models'
         Location for keeping the model parameters.
     """
-    backbone = resnet18(pretrained=pretrained_backbone).features
+    backbone = resnet18(pretrained=pretrained_backbone, features_only=True).features
     del backbone.final_pool
     return get_simplepose(backbone=backbone, backbone_out_channels=512, keypoints=keypoints,
                           model_name="simplepose_resnet18_coco", **kwargs)
@@ -259,7 +565,7 @@ def simplepose_resnet50b_coco(pretrained_backbone=False, keypoints=17, **kwargs)
     root : str, default '~/.chainer/models'
         Location for keeping the model parameters.
     """
-    backbone = resnet50b(pretrained=pretrained_backbone).features
+    backbone = resnet50b(pretrained=pretrained_backbone, features_only=True).features
     del backbone.final_pool
     return get_simplepose(backbone=backbone, backbone_out_channels=2048, keypoints=keypoints,
                           model_name="simplepose_resnet50b_coco", **kwargs)
@@ -281,7 +587,7 @@ def simplepose_resnet101b_coco(pretrained_backbone=False, keypoints=17, **kwargs
     root : str, default '~/.chainer/models'
         Location for keeping the model parameters.
     """
-    backbone = resnet101b(pretrained=pretrained_backbone).features
+    backbone = resnet101b(pretrained=pretrained_backbone, features_only=True).features
     del backbone.final_pool
     return get_simplepose(backbone=backbone, backbone_out_channels=2048, keypoints=keypoints,
                           model_name="simplepose_resnet101b_coco", **kwargs)
@@ -303,7 +609,7 @@ def simplepose_resnet152b_coco(pretrained_backbone=False, keypoints=17, **kwargs
     root : str, default '~/.chainer/models'
         Location for keeping the model parameters.
     """
-    backbone = resnet152b(pretrained=pretrained_backbone).features
+    backbone = resnet152b(pretrained=pretrained_backbone, features_only=True).features
     del backbone.final_pool
     return get_simplepose(backbone=backbone, backbone_out_channels=2048, keypoints=keypoints,
                           model_name="simplepose_resnet152b_coco", **kwargs)
@@ -325,7 +631,7 @@ def simplepose_resneta50b_coco(pretrained_backbone=False, keypoints=17, **kwargs
     root : str, default '~/.chainer/models'
         Location for keeping the model parameters.
     """
-    backbone = resneta50b(pretrained=pretrained_backbone).features
+    backbone = resneta50b(pretrained=pretrained_backbone, features_only=True).features
     del backbone.final_pool
     return get_simplepose(backbone=backbone, backbone_out_channels=2048, keypoints=keypoints,
                           model_name="simplepose_resneta50b_coco", **kwargs)
@@ -347,7 +653,7 @@ def simplepose_resneta101b_coco(pretrained_backbone=False, keypoints=17, **kwarg
     root : str, default '~/.chainer/models'
         Location for keeping the model parameters.
     """
-    backbone = resneta101b(pretrained=pretrained_backbone).features
+    backbone = resneta101b(pretrained=pretrained_backbone, features_only=True).features
     del backbone.final_pool
     return get_simplepose(backbone=backbone, backbone_out_channels=2048, keypoints=keypoints,
                           model_name="simplepose_resneta101b_coco", **kwargs)
@@ -369,7 +675,7 @@ def simplepose_resneta152b_coco(pretrained_backbone=False, keypoints=17, **kwarg
     root : str, default '~/.chainer/models'
         Location for keeping the model parameters.
     """
-    backbone = resneta152b(pretrained=pretrained_backbone).features
+    backbone = resneta152b(pretrained=pretrained_backbone, features_only=True).features
     del backbone.final_pool
     return get_simplepose(backbone=backbone, backbone_out_channels=2048, keypoints=keypoints,
                           model_name="simplepose_resneta152b_coco", **kwargs)
@@ -378,6 +684,7 @@ def simplepose_resneta152b_coco(pretrained_backbone=False, keypoints=17, **kwarg
 def _test():
     import numpy as np
     import chainer
+    from chainer.backends import cuda
 
     chainer.global_config.train = False
 
@@ -385,6 +692,7 @@ def _test():
     keypoints = 17
     return_heatmap = False
     pretrained = False
+    use_gpu = False
 
     models = [
         simplepose_resnet18_coco,
@@ -411,6 +719,9 @@ def _test():
 
         batch = 14
         x = np.random.rand(batch, 3, in_size[0], in_size[1]).astype(np.float32)
+        if use_gpu:
+            net.to_gpu()
+            x = cuda.to_gpu(x)
         y = net(x)
         assert ((y.shape[0] == batch) and (y.shape[1] == keypoints))
         if return_heatmap:
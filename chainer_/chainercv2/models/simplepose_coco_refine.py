@@ -0,0 +1,57 @@
+"""
+    Numba-compiled keypoint extraction for SimplePose (optional, for NumPy heatmaps). This module requires Numba, so
+    it is imported lazily. Kernels are not cached on disk, because the package is importable under two module names
+    (`chainercv2` and `chainer_.chainercv2`) and a cache compiled under one of them fails to load under the other.
+"""
+
+__all__ = ['refine_keypoints', 'NumbaError']
+
+from numba import njit, prange
+from numba.core.errors import NumbaError
+
+
+@njit
+def _sign_step(a, b):
+    """
+    Quarter-pixel shift towards the larger of two neighbours, i.e. sign(a - b) * 0.25 without branches.
+    """
+    return 0.25 * (int(a > b) - int(a < b))
+
+
+@njit(parallel=True)
+def refine_keypoints(heatmap, keypoints):
+    """
+    Extract keypoints from heatmaps with quarter-pixel refinement of peak locations.
+
+    Parameters:
+    ----------
+    heatmap : numpy.ndarray
+        Heatmaps of shape (batch, keypoints, out_height, out_width).
+    keypoints : numpy.ndarray
+        Output array of shape (batch, keypoints, 3) for (x, y, score) triples.
+    """
+    batch, keypoint_count, height, width = heatmap.shape
+    for n in prange(batch * keypoint_count):
+        b = n // keypoint_count
+        k = n % keypoint_count
+        hm = heatmap[b, k]
+        score = hm[0, 0]
+        px = 0
+        py = 0
+        for i in range(height):
+            for j in range(width):
+                if hm[i, j] > score:
+                    score = hm[i, j]
+                    py = i
+                    px = j
+        x = 0.0
+        y = 0.0
+        if score > 0.0:
+            x = float(px)
+            y = float(py)
+            if (1 < px < width - 1) and (1 < py < height - 1):
+                x += _sign_step(hm[py, px + 1], hm[py, px - 1])
+                y += _sign_step(hm[py + 1, px], hm[py - 1, px])
+        keypoints[b, k, 0] = x
+        keypoints[b, k, 1] = y
+        keypoints[b, k, 2] = score